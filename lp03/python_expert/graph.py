@@ -1,33 +1,119 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from functools import wraps
-import json
+import inspect
 import logging
-from typing import Annotated, Any, Callable, Dict, List
+import os
+from typing import Annotated, Any, AsyncIterator, Callable, Dict, List, Tuple
 from typing_extensions import TypedDict
 import uuid
 
+import aiosqlite
+import boto3
+from botocore.config import Config
 from langchain_aws import ChatBedrockConverse
-from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.graph import END, START, StateGraph
 from langgraph.graph.message import add_messages
 from langgraph.graph.state import CompiledGraph
+import orjson
 
-from python_expert.tools import TOOLS_ALL, TOOLS_NORMAL, Transform, make_transform_tool
+from python_expert.tools import Transform, make_transform_tool
 from utilities.opensearch_client import OpenSearchClient
 from utilities.rest_client import ConnectionDetails, RESTClient
-from utilities.testing import test_index_transform
-from utilities.transforms import get_transform_file_path, get_transform_input_file_path, get_transform_output_file_path, get_transform_report_file_path, load_transform_from_file
+from utilities.testing import TransformReport, test_index_transform
+from utilities.transforms import get_transform_file_path, get_transform_input_file_path, get_transform_output_file_path, get_transform_report_file_path, load_transform_from_file, write_transform_file
 
 logger = logging.getLogger(__name__)
 
-# Define our LLM
+# Define our LLM.  We share a single Bedrock client with a pooled, kept-alive connection across invocations to
+# avoid paying for connection setup and TLS handshakes on every call.
+bedrock_config = Config(
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    max_pool_connections=32,
+    tcp_keepalive=True
+)
+bedrock_session = boto3.Session(region_name="us-west-2")
+bedrock_client = bedrock_session.client("bedrock-runtime", config=bedrock_config)
+
 llm = ChatBedrockConverse(
     model="anthropic.claude-3-5-sonnet-20240620-v1:0",
     temperature=0,
     max_tokens=4096,
-    region_name="us-west-2"
+    region_name="us-west-2",
+    client=bedrock_client
 )
-llm_with_tools = llm.bind_tools(TOOLS_ALL)
+# The graph only ever executes MakeTransform, so bind just that tool rather than every tool in TOOLS_ALL; each bound
+# tool's schema is resent with every LLM call
+llm_with_tools = llm.bind_tools([make_transform_tool])
+
+# Optionally open the connection at import time so the first graph run doesn't pay for it
+if os.environ.get("LP03_WARMUP") == "1":
+    logger.info("Warming up the LLM connection")
+    llm.invoke([HumanMessage(content="ping")])
+
+# Maximum number of messages retained in the Python expert's conversation history
+MAX_PYTHON_TURNS = 20
+
+def trim_messages_to_window(messages: List[BaseMessage], max_turns: int = MAX_PYTHON_TURNS) -> List[BaseMessage]:
+    """
+    Trims the history to a sliding window.  The opening messages through the first HumanMessage are always
+    retained.  The rest is trimmed oldest-first in whole units, where an AIMessage making tool calls forms a unit with
+    the ToolMessages answering those calls, so no ToolMessage is ever kept without the tool call it answers.  The
+    most recent unit is always kept.
+    """
+    if len(messages) <= max_turns:
+        return messages
+
+    head_end = next((i + 1 for i, message in enumerate(messages) if isinstance(message, HumanMessage)), 0)
+    head, tail = messages[:head_end], messages[head_end:]
+
+    # Walk forward assigning each message to a unit, attaching ToolMessages to the unit that made their tool call
+    unit_by_tool_call_id = {}
+    message_units = []
+    unit_sizes = []
+    for message in tail:
+        if isinstance(message, ToolMessage) and message.tool_call_id in unit_by_tool_call_id:
+            unit = unit_by_tool_call_id[message.tool_call_id]
+        else:
+            unit = len(unit_sizes)
+            unit_sizes.append(0)
+            if isinstance(message, AIMessage):
+                for tool_call in message.tool_calls:
+                    unit_by_tool_call_id[tool_call["id"]] = unit
+        unit_sizes[unit] += 1
+        message_units.append(unit)
+
+    # Keep as many of the newest units as fit in the remaining budget
+    budget = max(max_turns - head_end, 0)
+    first_kept_unit = len(unit_sizes) - 1
+    kept_size = unit_sizes[first_kept_unit] if unit_sizes else 0
+    while first_kept_unit > 0 and kept_size + unit_sizes[first_kept_unit - 1] <= budget:
+        first_kept_unit -= 1
+        kept_size += unit_sizes[first_kept_unit]
+
+    window = [message for message, unit in zip(tail, message_units) if unit >= first_kept_unit]
+
+    # Drop any ToolMessage whose tool call isn't in the window
+    kept_tool_call_ids = {
+        tool_call["id"]
+        for message in window if isinstance(message, AIMessage)
+        for tool_call in message.tool_calls
+    }
+    window = [
+        message for message in window
+        if not isinstance(message, ToolMessage) or message.tool_call_id in kept_tool_call_ids
+    ]
+
+    return head + window
+
+def windowed_messages(left: List[BaseMessage], right: List[BaseMessage]) -> List[BaseMessage]:
+    """
+    Reducer that merges messages like add_messages, then trims the result to a sliding window
+    """
+    return trim_messages_to_window(add_messages(left, right))
 
 # Define the state our graph will be operating on
 class PythonState(TypedDict):
@@ -38,8 +124,11 @@ class PythonState(TypedDict):
     input: Dict[str, Any]
     output: List[Dict[str, Any]]
 
+    # Hold the system prompt separately so it isn't accumulated and checkpointed with every turn
+    system_prompt: str
+
     # Hold the internal conversation of the Python expert
-    python_turns: Annotated[List[BaseMessage], add_messages]
+    python_turns: Annotated[List[BaseMessage], windowed_messages]
 
     # Retain details on the current Transform we're working on
     transform: Transform
@@ -47,35 +136,61 @@ class PythonState(TypedDict):
     transform_files_dir: str
 
 def python_state_to_json(state: PythonState) -> Dict[str, Any]:
+    python_turns = state.get("python_turns")
     return {
-        "python_turns": [turn.to_json() for turn in state.get("python_turns", [])],
+        "python_turns": [turn.to_json() for turn in python_turns] if python_turns else [],
         "transform": state.get("transform").to_json() if state.get("transform") else None,
         "transform_id": state.get("transform_id", None),
         "transform_files_dir": state.get("transform_files_dir", None)
     }
     
+def _log_node_entry(func: Callable, state: PythonState) -> None:
+    node_logger = logging.getLogger(func.__module__)
+    node_logger.info("Entering node: %s", func.__name__)
+    # Serializing the state is O(N) in the conversation length, so skip it unless it will be emitted
+    if node_logger.isEnabledFor(logging.DEBUG):
+        node_logger.debug("Starting state: %s", orjson.dumps(python_state_to_json(state), default=str, option=orjson.OPT_NON_STR_KEYS).decode("utf-8"))
+
+def _log_node_exit(func: Callable, result: Dict[str, Any]) -> None:
+    node_logger = logging.getLogger(func.__module__)
+    if node_logger.isEnabledFor(logging.DEBUG):
+        node_logger.debug("Output of %s: %s", func.__name__, result)
+
 def trace_python_node(func: Callable[[PythonState], Dict[str, Any]]) -> Callable[[PythonState], Dict[str, Any]]:
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(state: Dict[str, Any]) -> Dict[str, Any]:
+            _log_node_entry(func, state)
+            result = await func(state)
+            _log_node_exit(func, result)
+            return result
+
+        return async_wrapper
+
     @wraps(func)
     def wrapper(state: Dict[str, Any]) -> Dict[str, Any]:
-        logging.info(f"Entering node: {func.__name__}")
-        state_json = python_state_to_json(state)
-        logging.debug(f"Starting state: {str(state_json)}")
-        
+        _log_node_entry(func, state)
         result = func(state)
-        
-        logging.debug(f"Output of {func.__name__}: {result}")
-        
+        _log_node_exit(func, result)
         return result
     
     return wrapper
 
-# Set up our tools
-tools_normal_by_name = {tool.name: tool for tool in TOOLS_NORMAL}
+# Shared pool used to overlap independent transform file writes
+transform_io_pool = ThreadPoolExecutor(max_workers=4)
 
-# Initialize memory to persist state between graph runs
-checkpointer = MemorySaver()
+# Use an on-disk checkpointer to persist state between graph runs without holding it all in memory.  The async
+# checkpointer must be created inside a running event loop, so the runner opens one per graph run.
+CHECKPOINT_DB_PATH = "./checkpoints.db"
 
-# Define our graph
+@asynccontextmanager
+async def open_checkpointer(db_path: str = CHECKPOINT_DB_PATH) -> AsyncIterator[AsyncSqliteSaver]:
+    async with aiosqlite.connect(db_path) as conn:
+        yield AsyncSqliteSaver(conn)
+
+# Define our graph.  By default the transform is made and tested in a single node; set LP03_SPLIT_TRANSFORM_NODES=1
+# to run them as separate nodes so each step is individually visible in the stream and checkpoints.
+SPLIT_TRANSFORM_NODES = os.environ.get("LP03_SPLIT_TRANSFORM_NODES") == "1"
 python_graph = StateGraph(PythonState)
 
 # Set up our graph nodes
@@ -90,18 +205,28 @@ def node_validate_starting_state(state: PythonState):
     if not state.get("transform_files_dir", None):
         raise MissingStateError("State 'transform_files_dir' is missing.  You must provide an absolute path to a directory to store transform files.")
 
+    if not state.get("system_prompt", None):
+        raise MissingStateError("State 'system_prompt' is missing.  You must provide the system prompt for the Python expert.")
+
     return {"python_turns": []}
 
 @trace_python_node
-def node_invoke_llm_python(state: PythonState):
-    python_turns = state["python_turns"]
-    response = llm_with_tools.invoke(python_turns)
+async def node_invoke_llm_python(state: PythonState):
+    python_turns = [SystemMessage(content=state["system_prompt"])] + state["python_turns"]
+
+    # Stream the response so callers can surface tokens as they arrive, then assemble the full message.  This is
+    # async so that the event loop can make progress on other graph runs while we wait on the LLM.  ChatBedrockConverse
+    # has no native async implementation, so astream() runs the blocking Bedrock stream on an executor thread; the
+    # concurrency across graph runs comes from those threads, not from non-blocking I/O.
+    response = None
+    async for chunk in llm_with_tools.astream(python_turns):
+        response = chunk if response is None else response + chunk
     return {"python_turns": [response]}
 
-@trace_python_node
-def node_make_transform(state: PythonState) -> Dict[str, any]:
+def _make_transform(state: PythonState) -> Tuple[Dict[str, Any], Dict[str, Any], str]:
     """
-    Node to create or update our transform
+    Creates the transform requested by the latest tool call and writes it to disk.  Returns the State update, the tool
+    call, and the path of the transform file.
     """
     # Generate the transform
     tool_call = state["python_turns"][-1].tool_calls[-1]
@@ -109,37 +234,31 @@ def node_make_transform(state: PythonState) -> Dict[str, any]:
     transform_id = state.get("transform_id", str(uuid.uuid4())) # Pick an ID if we don't have one
     logger.info(f"Generated transform with ID: {transform_id}")
 
-    # Store the transform in a file
+    # Store the transform in a file, and the input in a file as well.  The writes are independent, so overlap them.
     raw_file_contents = f"{transform.imports}\n\n\"\"\"\n{transform.description}\n\"\"\"\n\n{transform.code}"
     file_path = get_transform_file_path(state["transform_files_dir"], transform_id)
-    with open(file_path, "w") as f:
-        f.write(raw_file_contents)
-    logger.info(f"Transform written to file: {file_path}")
-
-    # Store the input in a file as well
     input_file_path = get_transform_input_file_path(state["transform_files_dir"], transform_id)
-    with open(input_file_path, "w") as f:
-        f.write(json.dumps(state.get("input", {}), indent=4))
-    
-    # Update our State and exit the node.  We create a tool message to capture our work creating the transform,
-    # and an AIMessage message to return to the original caller.
-    result = []
-    tool_message = ToolMessage(name="MakeTransform", content=transform.to_json(), tool_call_id=tool_call["id"])
-    ai_message = AIMessage(content=f"Transform created at path: {file_path}")
-    result.append(tool_message)
-    result.append(ai_message)
+    write_futures = [
+        transform_io_pool.submit(write_transform_file, file_path, raw_file_contents.encode("utf-8")),
+        transform_io_pool.submit(write_transform_file, input_file_path, orjson.dumps(state.get("input", {}), option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    ]
+    for write_future in write_futures:
+        write_future.result()
+    logger.info(f"Transform written to file: {file_path}")
 
-    return {"python_turns": result, "transform": transform, "transform_id": transform_id}
+    return {"transform": transform, "transform_id": transform_id}, tool_call, file_path
 
-@trace_python_node
-def node_test_transform(state: PythonState) -> Dict[str, Any]:
+def _test_transform(state: PythonState) -> Tuple[Dict[str, Any], TransformReport, str]:
     """
-    Node to test the transform.
+    Tests the current transform against the input and writes the results to disk.  Returns the State update, the test
+    report, and the path of the output file.
     """
-    # Load the input data from the file
-    input_file_path = get_transform_input_file_path(state["transform_files_dir"], state["transform_id"])
-    with open(input_file_path, "r") as f:
-        input_data = json.load(f)
+    # Use the input data already in our State, only falling back to the file written by node_make_transform
+    input_data = state.get("input")
+    if not input_data:
+        input_file_path = get_transform_input_file_path(state["transform_files_dir"], state["transform_id"])
+        with open(input_file_path, "rb") as f:
+            input_data = orjson.loads(f.read())
 
     # Load the transform function to be tested
     transform_file_path = get_transform_file_path(state["transform_files_dir"], state["transform_id"])
@@ -151,31 +270,80 @@ def node_test_transform(state: PythonState) -> Dict[str, Any]:
     )
     result = test_index_transform(input_data, transform_function, test_client)
 
-    # Store the result of the test in a file
+    # Store the result of the test and the output in files, overlapping the independent writes
     report_file_path = get_transform_report_file_path(state["transform_files_dir"], state["transform_id"])
-    with open(report_file_path, "w") as f:
-        f.write(json.dumps(result.to_json(), indent=4))
-        
-    # Store the output in a file
     output_file_path = get_transform_output_file_path(state["transform_files_dir"], state["transform_id"])
-    with open(output_file_path, "w") as f:
-        f.write(json.dumps(result.output, indent=4))
+    write_futures = [
+        transform_io_pool.submit(write_transform_file, report_file_path, orjson.dumps(result.to_json(), option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)),
+        transform_io_pool.submit(write_transform_file, output_file_path, orjson.dumps(result.output, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    ]
+    for write_future in write_futures:
+        write_future.result()
+
+    return {"output": result.output}, result, output_file_path
+
+@trace_python_node
+def node_make_transform(state: PythonState) -> Dict[str, Any]:
+    """
+    Node to create or update our transform
+    """
+    state_update, tool_call, file_path = _make_transform(state)
 
-    # Update our State and exit the node.  We create a tool message to capture our work testing the transform,
+    # Update our State and exit the node.  We create a tool message to capture our work creating the transform,
     # and an AIMessage message to return to the original caller.
+    result = []
+    tool_message = ToolMessage(name="MakeTransform", content=orjson.dumps(state_update["transform"].to_json()).decode("utf-8"), tool_call_id=tool_call["id"])
+    ai_message = AIMessage(content=f"Transform created at path: {file_path}")
+    result.append(tool_message)
+    result.append(ai_message)
+
+    return {**state_update, "python_turns": result}
+
+@trace_python_node
+def node_test_transform(state: PythonState) -> Dict[str, Any]:
+    """
+    Node to test the transform.
+    """
+    state_update, report, output_file_path = _test_transform(state)
+
+    # Update our State and exit the node.  The MakeTransform tool call was already answered by node_make_transform, so
+    # the test report is passed back as a regular message rather than a second result for the same tool call.
     messages = []
-    transform_test_result_message = f"Result of executing the transform on the input:\n{json.dumps(result.to_json())}"
-    tool_message = ToolMessage(name="TestTransform", content=transform_test_result_message, tool_call_id=uuid.uuid4())
+    report_message = HumanMessage(name="TestTransform", content=orjson.dumps(report.to_json(), option=orjson.OPT_NON_STR_KEYS).decode("utf-8"))
     ai_message = AIMessage(content=f"Transform tested successfully.  Output written to: {output_file_path}")
-    messages.append(tool_message)
+    messages.append(report_message)
     messages.append(ai_message)
 
-    return {"python_turns": messages, "output": result.output}
+    return {**state_update, "python_turns": messages}
+
+@trace_python_node
+def node_make_and_test_transform(state: PythonState) -> Dict[str, Any]:
+    """
+    Node to create or update our transform and then immediately test it.  Doing both in a single node saves a round
+    of state reduction and checkpointing compared to running node_make_transform and node_test_transform separately.
+    """
+    make_update, tool_call, file_path = _make_transform(state)
+    test_update, report, output_file_path = _test_transform({**state, **make_update})
+
+    # Update our State and exit the node.  The transform and its test report are returned together as the single
+    # result of the MakeTransform tool call, passed as a structured JSON content block so it is only encoded once, on
+    # its way to Bedrock.  We also create an AIMessage message to return to the original caller.
+    result = []
+    tool_content = {"transform": make_update["transform"].to_json(), "test_report": report.to_json()}
+    tool_message = ToolMessage(name="MakeTransform", content=[{"type": "json", "json": tool_content}], tool_call_id=tool_call["id"])
+    ai_message = AIMessage(content=f"Transform created at path: {file_path} and tested.  Output written to: {output_file_path}")
+    result.append(tool_message)
+    result.append(ai_message)
+
+    return {**make_update, **test_update, "python_turns": result}
 
 python_graph.add_node("node_validate_starting_state", node_validate_starting_state)
 python_graph.add_node("node_invoke_llm_python", node_invoke_llm_python)
-python_graph.add_node("node_make_transform", node_make_transform)
-python_graph.add_node("node_test_transform", node_test_transform)
+if SPLIT_TRANSFORM_NODES:
+    python_graph.add_node("node_make_transform", node_make_transform)
+    python_graph.add_node("node_test_transform", node_test_transform)
+else:
+    python_graph.add_node("node_make_and_test_transform", node_make_and_test_transform)
 
 # Define our graph edges
 # def next_node(state: PythonState) -> Literal["node_make_transform", END]:
@@ -189,31 +357,61 @@ python_graph.add_node("node_test_transform", node_test_transform)
 
 python_graph.add_edge(START, "node_validate_starting_state")
 python_graph.add_edge("node_validate_starting_state", "node_invoke_llm_python")
-python_graph.add_edge("node_invoke_llm_python", "node_make_transform")
 # python_graph.add_conditional_edges("node_invoke_llm_python", next_node)
-python_graph.add_edge("node_make_transform", "node_test_transform")
-python_graph.add_edge("node_test_transform", END)
-
-# Finally, compile the graph into a LangChain Runnable
-PYTHON_GRAPH = python_graph.compile(checkpointer=checkpointer)
+if SPLIT_TRANSFORM_NODES:
+    python_graph.add_edge("node_invoke_llm_python", "node_make_transform")
+    python_graph.add_edge("node_make_transform", "node_test_transform")
+    python_graph.add_edge("node_test_transform", END)
+else:
+    python_graph.add_edge("node_invoke_llm_python", "node_make_and_test_transform")
+    python_graph.add_edge("node_make_and_test_transform", END)
+
+# Finally, compile the graph into a LangChain Runnable.  The checkpointer is attached by the runner.
+PYTHON_GRAPH = python_graph.compile()
+
+def _create_async_runner(workflow: CompiledGraph):
+    async def arun_workflow(cw_state: PythonState, thread: str) -> PythonState:
+        async with open_checkpointer() as checkpointer:
+            events = workflow.copy({"checkpointer": checkpointer}).astream(
+                cw_state,
+                config={"configurable": {"thread_id": thread}},
+                stream_mode=["values", "messages"]
+            )
+
+            final_state = None
+            async for stream_mode, payload in events:
+                if stream_mode == "messages":
+                    message_chunk, _ = payload
+                    logger.debug(f"Received message chunk: {message_chunk.content}")
+                    continue
+
+                state = payload
+                if "python_turns" in state:
+                    state["python_turns"][-1].pretty_print()
+                    logger.info(state["python_turns"][-1].to_json())
+                final_state = state
+
+            return final_state
+
+    return arun_workflow
 
 def _create_runner(workflow: CompiledGraph):
-    def run_workflow(cw_state: PythonState, thread: int) -> PythonState:
-        states = workflow.stream(
-            cw_state,
-            config={"configurable": {"thread_id": thread}},
-            stream_mode="values"
-        )
+    arun_workflow = _create_async_runner(workflow)
 
-        final_state = None
-        for state in states:
-            if "python_turns" in state:
-                state["python_turns"][-1].pretty_print()
-                logger.info(state["python_turns"][-1].to_json())
-            final_state = state
+    def run_workflow(cw_state: PythonState, thread: str) -> PythonState:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(arun_workflow(cw_state, thread))
 
-        return final_state
+        raise RuntimeError(
+            "PYTHON_GRAPH_RUNNER cannot be called while an event loop is running (e.g. in Jupyter/IPython).  "
+            "Use 'await PYTHON_GRAPH_ASYNC_RUNNER(...)' instead."
+        )
 
     return run_workflow
 
-PYTHON_GRAPH_RUNNER = _create_runner(PYTHON_GRAPH)
\ No newline at end of file
+# Use the async runner to drive multiple graph runs concurrently from a single event loop, or from code that already
+# has a running loop (such as Jupyter/IPython).  The synchronous runner starts its own loop for each run.
+PYTHON_GRAPH_ASYNC_RUNNER = _create_async_runner(PYTHON_GRAPH)
+PYTHON_GRAPH_RUNNER = _create_runner(PYTHON_GRAPH)
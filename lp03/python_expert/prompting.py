@@ -1,4 +1,6 @@
-from typing import Dict, Any
+from functools import lru_cache
+import re
+from typing import Any, Dict, List
 
 from langchain_core.messages import SystemMessage
 
@@ -58,13 +60,26 @@ You will do this by ensuring your transform code returns each new index as a sep
 </multitype_mapping_guidance>
 """
 
+# Pre-split the template into alternating literal text and placeholder names so that filling it in is a join
+# rather than a fresh format-string parse on every call
+_index_prompt_parts = re.split(r"\{(\w+)\}", index_prompt_template)
 
-def get_transform_index_prompt(source_version: str, target_version: str, source_json: Dict[str, Any]) -> str:
+def _fill_prompt_parts(prompt_parts: List[str], **kwargs: Any) -> str:
+    return "".join(part if i % 2 == 0 else str(kwargs[part]) for i, part in enumerate(prompt_parts))
+
+@lru_cache(maxsize=64)
+def _build_transform_index_prompt_content(source_version: str, target_version: str, source_json_str: str) -> str:
+    return _fill_prompt_parts(
+        _index_prompt_parts,
+        source_version=source_version,
+        source_guidance=es_68_source_guidance,
+        target_version=target_version,
+        source_json=source_json_str
+    )
+
+def get_transform_index_prompt(source_version: str, target_version: str, source_json: Dict[str, Any]) -> SystemMessage:
+    # The source JSON is rendered to the string that gets embedded in the prompt and used as part of the cache key,
+    # so any input the template accepts can be cached.  Only the content is cached; each caller gets its own message.
     return SystemMessage(
-        content=index_prompt_template.format(
-            source_version=source_version,
-            source_guidance=es_68_source_guidance,
-            target_version=target_version,
-            source_json=source_json
-        )
+        content=_build_transform_index_prompt_content(source_version, target_version, str(source_json))
     )
\ No newline at end of file
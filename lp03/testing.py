@@ -1,4 +1,5 @@
 import logging
+import uuid
 
 from langchain_core.messages import HumanMessage
 
@@ -49,16 +50,15 @@ connection_details = ConnectionDetails(
 
 python_state = PythonState(
     input = transform_input,
-    python_turns = [
-        system_message
-    ],
+    system_prompt = system_message.content,
+    python_turns = [],
     connection_details = connection_details,
     transform_files_dir="/tmp/transforms"
 )
 python_state["python_turns"].append(
     HumanMessage(content="Please make the transform")
 )
-final_state = PYTHON_GRAPH_RUNNER(python_state, 42)
+final_state = PYTHON_GRAPH_RUNNER(python_state, str(uuid.uuid4())) # Checkpoints persist on disk, so use a fresh thread per run
 logger.info(f"Final state: {python_state_to_json(final_state)}")
 
 
@@ -1,7 +1,8 @@
 from dataclasses import dataclass
-import json
 from typing import Any, Callable, Dict, List
 
+import orjson
+
 from utilities.opensearch_client import OpenSearchClient
 
 @dataclass
@@ -31,10 +32,10 @@ def test_index_transform(input: Dict[str, Any], transform: Callable[[Dict[str, A
             settings = index_def["indexJson"]
             report_incidents.append(f"Attempting to create & delete index '{index_name}' with transformed settings...")
             create_response = test_client.create_index(index_name, settings)
-            report_incidents.append(f"Created index '{index_name}'.  Response: \n{json.dumps(create_response)}")
+            report_incidents.append(f"Created index '{index_name}'.  Response: \n{orjson.dumps(create_response).decode()}")
 
             delete_response = test_client.delete_index(index_name)
-            report_incidents.append(f"Deleted index '{index_name}'.  Response: \n{json.dumps(delete_response)}")
+            report_incidents.append(f"Deleted index '{index_name}'.  Response: \n{orjson.dumps(delete_response).decode()}")
 
         passed = True
     except Exception as e:
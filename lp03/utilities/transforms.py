@@ -1,6 +1,17 @@
-import importlib
+from collections import OrderedDict
+from functools import lru_cache
 import os
-from typing import Any, Callable, Dict, List
+import tempfile
+import threading
+from types import CodeType
+from typing import Any, Callable, Dict, List, Tuple
+
+# Loaded transform functions, keyed on (path, inode, mtime_ns, size) so that edits to the file invalidate the entry.
+# Transform files are replaced atomically when rewritten, so every rewrite gets a new inode.
+_TRANSFORM_CACHE: "OrderedDict[Tuple[str, int, int, int], Callable[[Dict[str, Any]], List[Dict[str, Any]]]]" = OrderedDict()
+_TRANSFORM_CACHE_MAX_SIZE = 128
+# Sync graph nodes run on executor threads, so guard the cache's lookup/update/eviction steps
+_TRANSFORM_CACHE_LOCK = threading.Lock()
 
 def get_transform_file_path(transform_files_dir: str, transform_id: str) -> str:
     return os.path.join(transform_files_dir, f"{transform_id}_transform.py")
@@ -14,10 +25,52 @@ def get_transform_output_file_path(transform_files_dir: str, transform_id: str)
 def get_transform_report_file_path(transform_files_dir: str, transform_id: str) -> str:
     return os.path.join(transform_files_dir, f"{transform_id}_report.json")
 
+# fdatasync() skips flushing metadata that isn't needed to read the data back, but isn't available on every platform
+_sync_file_data = getattr(os, "fdatasync", os.fsync)
+
+def write_transform_file(file_path: str, contents: bytes) -> None:
+    # Write the pre-serialized contents with a single unbuffered write to a temporary file in the same directory, sync
+    # its data once, then swap it into place so readers never see a partially-written file
+    fd, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or ".", prefix=".tmp_")
+    try:
+        view = memoryview(contents)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+        _sync_file_data(fd)
+    except BaseException:
+        os.close(fd)
+        os.unlink(temp_file_path)
+        raise
+    os.close(fd)
+    os.chmod(temp_file_path, 0o644)
+    os.replace(temp_file_path, file_path)
+
+@lru_cache(maxsize=_TRANSFORM_CACHE_MAX_SIZE)
+def _compile_transform_source(transform_source: bytes, transform_file_path: str) -> CodeType:
+    return compile(transform_source, transform_file_path, "exec")
+
 def load_transform_from_file(transform_file_path: str) -> Callable[[Dict[str, Any]], List[Dict[str, Any]]]:
-    module_spec = importlib.util.spec_from_file_location("transform", transform_file_path)
-    if module_spec is None:
-        raise ImportError(f"Cannot load the transform module from {transform_file_path}")
-    module = importlib.util.module_from_spec(module_spec)
-    module_spec.loader.exec_module(module)
-    return module.transform
\ No newline at end of file
+    file_stat = os.stat(transform_file_path)
+    cache_key = (transform_file_path, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+    with _TRANSFORM_CACHE_LOCK:
+        cached_function = _TRANSFORM_CACHE.get(cache_key)
+        if cached_function is not None:
+            _TRANSFORM_CACHE.move_to_end(cache_key)
+            return cached_function
+
+    # The transform file only needs to define a single function, so compile and execute it into a bare namespace
+    # rather than going through the full importlib spec/loader machinery
+    with open(transform_file_path, "rb") as f:
+        transform_source = f.read()
+    transform_namespace = {"__name__": "transform", "__file__": transform_file_path}
+    exec(_compile_transform_source(transform_source, transform_file_path), transform_namespace)
+    if "transform" not in transform_namespace:
+        raise ImportError(f"No transform function is defined in {transform_file_path}")
+    transform_function = transform_namespace["transform"]
+
+    with _TRANSFORM_CACHE_LOCK:
+        _TRANSFORM_CACHE[cache_key] = transform_function
+        if len(_TRANSFORM_CACHE) > _TRANSFORM_CACHE_MAX_SIZE:
+            _TRANSFORM_CACHE.popitem(last=False)
+    return transform_function